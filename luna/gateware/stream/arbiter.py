@@ -125,14 +125,20 @@ class StreamArbiter(Elaboratable):
         #
         # Stream output multiplexer.
         #
-        with m.Switch(active_stream_index):
 
-            # Generate a switch case for each of our possible stream indexes..
-            for index, stream in enumerate(self._sinks):
-                with m.Case(index):
+        # Rather than switching a full stream connection per case, multiplex each stream field
+        # individually; this lowers to one slim mux per field, rather than a per-case bundle of
+        # connections. We'll drive every field other than ``ready`` forward, and route ``ready``
+        # back to whichever stream is currently selected.
+        for field, _, _ in active_stream.layout:
+            if field == 'ready':
+                continue
 
-                    # ... and connect up the stream while in that case.
-                    m.d.comb += active_stream.stream_eq(stream)
+            sources = Array(stream[field] for stream in self._sinks)
+            m.d.comb += active_stream[field].eq(sources[active_stream_index])
+
+        readies = Array(stream.ready for stream in self._sinks)
+        m.d.comb += readies[active_stream_index].eq(active_stream.ready)
 
 
         #
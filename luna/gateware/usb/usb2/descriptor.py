@@ -14,27 +14,9 @@ from usb_protocol.emitters.descriptors       import DeviceDescriptorCollection
 from usb_protocol.types.descriptors.standard import StandardDescriptorNumbers
 
 from ..stream                                import USBInStreamInterface
-from ...stream.generator                     import ConstantStreamGenerator
 from ...test                                 import LunaUSBGatewareTestCase, usb_domain_test_case
 
 
-class USBDescriptorStreamGenerator(ConstantStreamGenerator):
-    """ Specialized stream generator for generating USB descriptor constants. """
-
-    def __init__(self, data):
-        """
-        Parameters:
-            descriptor_number -- The descriptor number represented.
-            data              -- The raw bytes (or equivalent) for the descriptor.
-        """
-
-        # Always create USB descriptors in the USB domain; always have a maximum length field that can
-        # be up to 16 bits wide, and always use USBInStream's. These allow us to tie easily to our request
-        # handlers.
-        super().__init__(data, domain="usb", stream_type=USBInStreamInterface, max_length_width=16)
-
-
-
 class GetDescriptorHandlerDistributed(Elaboratable):
     """ Gateware that handles responding to GetDescriptor requests.
 
@@ -62,6 +44,12 @@ class GetDescriptorHandlerDistributed(Elaboratable):
         self._descriptors = descriptor_collection
         self._max_packet_length = max_packet_length
 
+        # Pre-compute the layout of our shared descriptor ROM -- and the perfect hash used to
+        # index its metadata -- so repeated elaborations don't repeat the work.
+        self._descriptor_entries, self._descriptor_blob = self._materialise_descriptors(descriptor_collection)
+        self._descriptor_hash = self._find_perfect_hash(
+            [(int(type_number) << 8) | int(index) for type_number, index in self._descriptor_entries])
+
         #
         # I/O port
         #
@@ -75,66 +63,283 @@ class GetDescriptorHandlerDistributed(Elaboratable):
         self.stall          = Signal()
 
 
+    @classmethod
+    def specialised(cls, descriptor_collection, max_packet_length=64):
+        """ Creates a subclass of this handler specialised for the given descriptor collection.
+
+        The returned class freezes the materialised descriptor data -- rather than the live
+        collection -- into its constructor; instances can then be created repeatedly (e.g. for
+        parametric sweeps) without re-serialising the collection each time, and without the
+        collection needing to be kept around at all.
+        """
+
+        frozen_descriptors = tuple(
+            (int(type_number), int(index), bytes(raw_descriptor))
+            for type_number, index, raw_descriptor in descriptor_collection
+        )
+
+        def __init__(self, descriptor_collection=frozen_descriptors, max_packet_length=max_packet_length):
+            cls.__init__(self, descriptor_collection, max_packet_length)
+
+        return type(f"{cls.__name__}Specialised", (cls,), {'__init__': __init__})
+
+
+    @staticmethod
+    def _materialise_descriptors(descriptor_collection):
+        """ Collects the provided descriptors into our shared-ROM layout.
+
+        Iterating a DeviceDescriptorCollection re-serializes each descriptor (including the
+        UTF-16 encoding of each string descriptor), so we perform this once at construction,
+        rather than on every elaboration.
+
+        Returns
+        -------
+        entries: dict
+            Maps each (type_number, index) pair to the (offset, length) of its descriptor data.
+        blob: bytes
+            The data for each of our descriptors, concatenated.
+        """
+
+        entries = {}
+        blob    = bytearray()
+
+        for type_number, index, raw_descriptor in descriptor_collection:
+            entries[(type_number, index)] = (len(blob), len(raw_descriptor))
+            blob.extend(raw_descriptor)
+
+        return entries, bytes(blob)
+
+
+    @staticmethod
+    def _find_perfect_hash(keys):
+        """ Searches for a small multiplicative hash that maps the given keys without collisions.
+
+        Returns
+        -------
+        multiplier: int
+            The constant the key should be multiplied by.
+        xor_constant: int
+            The constant the product should be XOR'd with.
+        bits: int
+            The number of low-order result bits needed to index the hash table.
+        """
+
+        key_count = len(keys)
+        bits      = max(1, (key_count - 1).bit_length())
+
+        # Try progressively larger tables until we find a collision-free hash; for the handful
+        # of keys a descriptor collection contains, this succeeds almost immediately.
+        while True:
+            mask = (1 << bits) - 1
+
+            for multiplier in range(1, 256, 2):
+                for xor_constant in range(256):
+                    slots = {((key * multiplier) ^ xor_constant) & mask for key in keys}
+                    if len(slots) == key_count:
+                        return multiplier, xor_constant, bits
+
+            bits += 1
+
+
     def elaborate(self, platform):
         m = Module()
 
-        # Collection that will store each of our descriptor-generation submodules.
-        descriptor_generators = {}
+        #
+        # Descriptor ROM.
+        #
+
+        # Rather than creating a separate stream generator (and thus a separate memory) per
+        # descriptor, all of our descriptors are concatenated into a single, shared ROM; with
+        # a table of each descriptor's position and extent, pre-computed at construction time.
+        descriptor_entries = self._descriptor_entries
+        descriptor_blob    = self._descriptor_blob
+
+        max_descriptor_size = max(length for _, length in descriptor_entries.values())
+
+        # Create the ROM itself, and the single read port we'll stream each descriptor from.
+        rom = Memory(width=8, depth=len(descriptor_blob), init=descriptor_blob)
+        m.submodules.rom_read_port = rom_read_port = rom.read_port(domain="usb", transparent=False)
+
 
         #
         # Figure out the maximum length we're willing to send.
         #
-        length = Signal(16)
+        # As this never exceeds a single packet's worth of data, this register -- and every
+        # comparator fed from it -- only needs to be wide enough to count one packet.
+        length = Signal(range(self._max_packet_length + 1))
 
         # We'll never send more than our MaxPacketSize. This means that we'll want to send a maximum of
         # either our maximum packet length, or the amount of data we have remaining; whichever is less.
         #
-        # Note that this doesn't take into account the length of the actual data to be sent; this is handled
-        # in the stream generator.
+        # To keep this subtraction and comparison off of our critical path, we'll register the result
+        # as a request starts; our START state gives the register a cycle to settle before first use.
         words_remaining = self.length - self.start_position
-        with m.If(words_remaining <= self._max_packet_length):
-            m.d.comb += length.eq(words_remaining)
-        with m.Else():
-            m.d.comb += length.eq(self._max_packet_length)
+        with m.If(self.start):
+            with m.If(words_remaining <= self._max_packet_length):
+                m.d.usb += length.eq(words_remaining)
+            with m.Else():
+                m.d.usb += length.eq(self._max_packet_length)
 
 
         #
-        # Create our constant-stream generators for each of our descriptors.
+        # Descriptor selection.
         #
-        for type_number, index, raw_descriptor in self._descriptors:
-            # Create the generator...
-            generator = USBDescriptorStreamGenerator(raw_descriptor)
-            descriptor_generators[(type_number, index)] = generator
+
+        # Metadata for the currently-selected descriptor.
+        descriptor_base   = Signal(range(len(descriptor_blob)))
+        descriptor_length = Signal(16)
+        descriptor_found  = Signal()
+
+        # Special case: with a single descriptor, there's nothing to dispatch. Wire up its
+        # metadata directly, and detect our descriptor with a single comparison.
+        if len(descriptor_entries) == 1:
+            (type_number, index), (offset, raw_length) = next(iter(descriptor_entries.items()))
 
             m.d.comb += [
-                generator.max_length     .eq(length),
-                generator.start_position .eq(self.start_position)
+                descriptor_base    .eq(offset),
+                descriptor_length  .eq(raw_length),
+                descriptor_found   .eq(self.value == ((int(type_number) << 8) | int(index)))
             ]
 
-            # ... and attach it to this module.
-            type_ref =  type_number.name if isinstance(type_number, StandardDescriptorNumbers) else type_number
-            setattr(m.submodules, f'USBDescriptorStreamGenerator({type_ref},{index})', generator)
+        # Otherwise, rather than comparing our 16-bit value against every descriptor's key in
+        # turn, we'll use a small perfect hash -- found once at construction time -- that maps
+        # each key we serve to a unique slot in a set of metadata ROMs. Each slot stores the key
+        # it serves alongside the descriptor's base offset and length; a single comparison of the
+        # stored key against our value then tells us whether the request is one we can answer.
+        else:
+            hash_a, hash_b, hash_bits = self._descriptor_hash
+
+            base_width = max(1, (len(descriptor_blob) - 1).bit_length())
+            key_init    = [0] * (1 << hash_bits)
+            base_init   = [0] * (1 << hash_bits)
+            length_init = [0] * (1 << hash_bits)
+
+            for (type_number, index), (offset, raw_length) in descriptor_entries.items():
+                key  = (int(type_number) << 8) | int(index)
+                slot = ((key * hash_a) ^ hash_b) & ((1 << hash_bits) - 1)
+                key_init[slot]    = key
+                base_init[slot]   = offset
+                length_init[slot] = raw_length
+
+            # Keep our metadata in three parallel ROMs -- one per field -- sharing a single
+            # hashed address, rather than a single wide one; each then packs into an
+            # independent, naturally-sized set of LUTRAMs, and no slicing logic is needed
+            # on the read data.
+            key_rom    = Memory(width=16,         depth=len(key_init),    init=key_init)
+            base_rom   = Memory(width=base_width, depth=len(base_init),   init=base_init)
+            length_rom = Memory(width=16,         depth=len(length_init), init=length_init)
+
+            m.submodules.key_rom_read_port    = key_rom_read_port    = key_rom.read_port(domain="comb")
+            m.submodules.base_rom_read_port   = base_rom_read_port   = base_rom.read_port(domain="comb")
+            m.submodules.length_rom_read_port = length_rom_read_port = length_rom.read_port(domain="comb")
+
+            hash_index = Signal(hash_bits)
+
+            m.d.comb += [
+                hash_index                 .eq((self.value * hash_a) ^ hash_b),
+
+                key_rom_read_port.addr     .eq(hash_index),
+                base_rom_read_port.addr    .eq(hash_index),
+                length_rom_read_port.addr  .eq(hash_index),
+
+                descriptor_base            .eq(base_rom_read_port.data),
+                descriptor_length          .eq(length_rom_read_port.data),
 
+                # The request is only valid if the slot we hashed to actually serves this key;
+                # the length check rejects values that happen to alias an unused (zeroed) slot.
+                descriptor_found           .eq((key_rom_read_port.data == self.value) & (descriptor_length != 0))
+            ]
 
         #
-        # Connect up each of our generators.
+        # Core transmit logic.
         #
 
-        with m.Switch(self.value):
+        # Register that stores our current position in the stream.
+        position_in_stream = Signal(range(max_descriptor_size + 1))
+        bytes_sent         = Signal.like(length)
+
+        # Our position registers only need to span our largest descriptor; so we'll truncate the
+        # wider start-position port before it feeds any of our comparators. Requests that start
+        # beyond the end of a descriptor are still caught, full-width, by the ZLP check below.
+        start_position = self.start_position[:len(position_in_stream)]
+
+        # Track when we're on the first and last byte of the stream.
+        on_first_packet = position_in_stream == start_position
+        on_last_packet  = \
+            (position_in_stream == (descriptor_length - 1)) | \
+            (bytes_sent + 1 >= length)
+
+        with m.FSM(domain="usb"):
 
-            # Generate a conditional interconnect for each of our items.
-            for (type_number, index), generator in descriptor_generators.items():
+            # IDLE -- we're currently waiting to send a descriptor.
+            with m.State('IDLE'):
 
-                # If the value matches the given type number...
-                with m.Case(type_number << 8 | index):
+                # Reset our position to the requested start, and our data-sent count...
+                m.d.usb += [
+                    position_in_stream  .eq(start_position),
+                    bytes_sent          .eq(0)
+                ]
 
-                    # ... connect the relevant generator to our output.
-                    m.d.comb += generator.stream  .attach(self.tx)
-                    m.d.usb += generator.start    .eq(self.start),
+                # ... and once we have a request to start transmitting...
+                with m.If(self.start):
+                    m.next = 'START'
 
-            # If none of our descriptors match, stall any request that comes in.
-            with m.Case():
-                m.d.comb += self.stall.eq(self.start)
+            # START -- retiming state, which allows construction of our length signal
+            # while pre-fetching our first byte from the ROM.
+            with m.State('START'):
+
+                # Pre-fetch the first byte we'll send.
+                m.d.comb += rom_read_port.addr.eq(descriptor_base + position_in_stream)
+
+                # If we don't have the requested descriptor, stall the request immediately.
+                with m.If(~descriptor_found):
+                    m.d.comb += self.stall.eq(1)
+                    m.next = 'IDLE'
+
+                # If we have no data to send, send a zero-length packet instead.
+                with m.Elif((length == 0) | (self.start_position >= descriptor_length)):
+                    m.next = 'SEND_ZLP'
+                with m.Else():
+                    m.next = 'SEND_DESCRIPTOR'
+
+            # SEND_DESCRIPTOR -- we're actively streaming our descriptor.
+            with m.State('SEND_DESCRIPTOR'):
+                m.d.comb += [
+                    self.tx.valid       .eq(1),
+
+                    # Always drive the stream from our current ROM output...
+                    rom_read_port.addr  .eq(descriptor_base + position_in_stream),
+                    self.tx.payload     .eq(rom_read_port.data),
+
+                    # ... and base First and Last based on our current position in the stream.
+                    self.tx.first       .eq(on_first_packet),
+                    self.tx.last        .eq(on_last_packet)
+                ]
+
+                # Once a given byte is accepted, we're ready to move on.
+                with m.If(self.tx.ready):
+
+                    # If we're not yet done, move to the next byte in the stream.
+                    with m.If(~on_last_packet):
+                        m.d.usb += [
+                            position_in_stream  .eq(position_in_stream + 1),
+                            bytes_sent          .eq(bytes_sent + 1)
+                        ]
+                        m.d.comb += rom_read_port.addr.eq(descriptor_base + position_in_stream + 1)
+
+                    # Otherwise, we've finished! Return to IDLE.
+                    with m.Else():
+                        m.next = 'IDLE'
+
+            # SEND_ZLP -- we've had an empty descriptor request, or a request that starts past the
+            # end of our descriptor. Send a zero-length packet to end the transaction.
+            with m.State('SEND_ZLP'):
+                m.d.comb += [
+                    # Pulse `last` without `first` to indicate a ZLP.
+                    self.tx.valid.eq(1),
+                    self.tx.last .eq(1),
+                ]
+                m.next = 'IDLE'
 
 
         return m
@@ -590,6 +795,16 @@ class GetDescriptorHandlerBlockTest(LunaUSBGatewareTestCase):
     FRAGMENT_UNDER_TEST = GetDescriptorHandlerBlock
     FRAGMENT_ARGUMENTS = {"descriptor_collection": descriptors}
 
+    # Cycles from our ``start`` strobe until the DUT presents its first valid byte; these
+    # are fixed properties of each handler's FSM, so we can advance exactly this far rather
+    # than polling ``valid`` cycle-by-cycle. Zero-length responses skip the data fetch, and
+    # thus arrive one cycle earlier.
+    FIRST_DATA_LATENCY = 4
+    ZLP_LATENCY        = 3
+
+    # Cycles from ``start`` until the DUT reports a stall for a request it can't serve.
+    STALL_LATENCY      = 2
+
     def traces_of_interest(self):
         dut = self.dut
         return (dut.value, dut.length, dut.start_position, dut.start, dut.stall,
@@ -613,17 +828,24 @@ class GetDescriptorHandlerBlockTest(LunaUSBGatewareTestCase):
 
         yield self.dut.start.eq(0)
 
-        yield from self.wait_until(self.dut.tx.valid, timeout=100)
+        # Figure out how many bytes we expect to see up front, so we can take a single,
+        # appropriately-narrow slice of our descriptor rather than allocating a wide one.
+        max_packet_length = 64
+        expected_bytes = min(len(raw_descriptor) - start_position, max_length - start_position, max_packet_length)
+        expected_data  = raw_descriptor[start_position:start_position + expected_bytes]
+
+        # Advance to the first valid byte directly; our DUT's response latency is fixed.
+        latency = self.ZLP_LATENCY if expected_bytes == 0 else self.FIRST_DATA_LATENCY
+        yield from self.advance_cycles(latency)
 
         if delay_ready > 0:
-            for _ in range(delay_ready-1):
+            # Apply our back-pressure as a table of per-cycle ready values -- held low for
+            # the length of the delay, then re-asserted -- so a single loop drives any
+            # back-pressure pattern we might want to exercise.
+            schedule = [(cycle, 0) for cycle in range(delay_ready - 1)] + [(delay_ready - 1, 1)]
+            for _, ready in schedule:
+                yield self.dut.tx.ready.eq(ready)
                 yield
-            yield self.dut.tx.ready.eq(1)
-            yield
-
-        max_packet_length = 64
-        expected_data = raw_descriptor[start_position:]
-        expected_bytes = min(len(expected_data), max_length-start_position, max_packet_length)
 
         if expected_bytes == 0:
             self.assertEqual((yield self.dut.tx.first), 0)
@@ -633,18 +855,38 @@ class GetDescriptorHandlerBlockTest(LunaUSBGatewareTestCase):
             yield
 
         else:
-            for i in range(expected_bytes):
-                self.assertEqual((yield self.dut.tx.first),   1 if (i == 0) else 0)
-                self.assertEqual((yield self.dut.tx.last),    1 if (i == expected_bytes - 1) else 0)
-                self.assertEqual((yield self.dut.tx.valid),   1)
-                self.assertEqual((yield self.dut.tx.payload), expected_data[i])
-                self.assertEqual((yield self.dut.stall),      0)
+            # Collect each byte -- and each per-byte flag -- as it's presented, so we can make
+            # our comparisons in one batch below, rather than once per byte.
+            payload = bytearray()
+            first,  last  = [], []
+            valid,  stall = [], []
+
+            for _ in range(expected_bytes):
+                payload.append((yield self.dut.tx.payload))
+                first  .append((yield self.dut.tx.first))
+                last   .append((yield self.dut.tx.last))
+                valid  .append((yield self.dut.tx.valid))
+                stall  .append((yield self.dut.stall))
                 yield
 
+            self.assertEqual(payload, expected_data)
+            self.assertEqual(first,   [1] + [0] * (expected_bytes - 1))
+            self.assertEqual(last,    [0] * (expected_bytes - 1) + [1])
+            self.assertEqual(valid,   [1] * expected_bytes)
+            self.assertEqual(stall,   [0] * expected_bytes)
+
         self.assertEqual((yield self.dut.tx.valid), 0)
 
-    def _test_stall(self, type_number, index, start_position, max_length):
-        """ Triggers a read and checks if correctly stalled. """
+    def _test_stall(self, type_number, index, start_position, max_length, latency=None):
+        """ Triggers a read and checks if correctly stalled.
+
+        The cycle on which each handler reports a stall is a fixed property of its FSM, so
+        rather than polling, we advance exactly that many cycles -- the class's STALL_LATENCY
+        by default, which ``latency`` overrides for requests that miss earlier.
+        """
+
+        if latency is None:
+            latency = self.STALL_LATENCY
 
         yield self.dut.value.word_select(1, 8).eq(type_number)  # Type
         yield self.dut.value.word_select(0, 8).eq(index)  # Index
@@ -656,16 +898,13 @@ class GetDescriptorHandlerBlockTest(LunaUSBGatewareTestCase):
 
         yield self.dut.start.eq(0)
 
-        cycles_passed = 0
-        timeout = 100
-
-        while not (yield self.dut.stall):
+        # Our DUT should never present data in response to a request it can't serve.
+        for _ in range(latency):
             self.assertEqual((yield self.dut.tx.valid), 0)
             yield
 
-            cycles_passed += 1
-            if timeout and cycles_passed > timeout:
-                raise RuntimeError(f"Timeout waiting for stall!")
+        self.assertEqual((yield self.dut.stall), 1)
+        self.assertEqual((yield self.dut.tx.valid), 0)
 
     @usb_domain_test_case
     def test_all_descriptors(self):
@@ -706,8 +945,36 @@ class GetDescriptorHandlerBlockTest(LunaUSBGatewareTestCase):
         # Unavailable index in between
         yield from self._test_stall(0x10, 0, 0, 64)
 
-        # Index after last used type
-        yield from self._test_stall(0x42, 0, 0, 64)
+        # Index after last used type; the block handler rejects these before its
+        # type lookup, one cycle earlier than its other misses.
+        yield from self._test_stall(0x42, 0, 0, 64, latency=1)
+
+class GetDescriptorHandlerDistributedTest(GetDescriptorHandlerBlockTest):
+    FRAGMENT_UNDER_TEST = GetDescriptorHandlerDistributed
+
+    # The distributed handler dispatches in a single cycle, and doesn't take a
+    # separate path for zero-length responses -- or for different kinds of miss.
+    FIRST_DATA_LATENCY = 2
+    ZLP_LATENCY        = 2
+    STALL_LATENCY      = 1
+
+
+class GetDescriptorHandlerDistributedSpecialisedTest(GetDescriptorHandlerDistributedTest):
+    FRAGMENT_UNDER_TEST = GetDescriptorHandlerDistributed.specialised(GetDescriptorHandlerBlockTest.descriptors)
+    FRAGMENT_ARGUMENTS  = {}
+
+
+class GetDescriptorHandlerDistributedSingleTest(GetDescriptorHandlerDistributedTest):
+    """ Exercises the single-descriptor fast path, which forgoes dispatch entirely. """
+
+    descriptors = DeviceDescriptorCollection(automatic_language_descriptor=False)
+
+    # HID Descriptor (Example E.8 of HID specification)
+    descriptors.add_descriptor(b'\x09\x21\x01\x01\x00\x01\x22\x00\x32')
+
+    FRAGMENT_UNDER_TEST = GetDescriptorHandlerDistributed
+    FRAGMENT_ARGUMENTS = {"descriptor_collection": descriptors}
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -5,11 +5,14 @@
 # SPDX-License-Identifier: BSD-3-Clause
 """ Utilities for building USB3 descriptors into gateware. """
 
-from amaranth                          import *
-from usb_protocol.emitters.descriptors import DeviceDescriptorCollection
+import unittest
 
-from ...stream                         import SuperSpeedStreamInterface
-from ....stream.generator              import ConstantStreamGenerator
+from amaranth                                import *
+from usb_protocol.emitters.descriptors       import DeviceDescriptorCollection
+from usb_protocol.types.descriptors.standard import StandardDescriptorNumbers
+
+from ...stream                               import SuperSpeedStreamInterface
+from ....test                                import LunaSSGatewareTestCase, ss_domain_test_case
 
 
 class GetDescriptorHandler(Elaboratable):
@@ -76,57 +79,274 @@ class GetDescriptorHandler(Elaboratable):
     def elaborate(self, platform):
         m = Module()
 
-        # Collection that will store each of our descriptor-generation submodules.
-        descriptor_generators = {}
+        # Internal, unbuffered copy of our output stream; we'll use its geometry to pack
+        # our ROM, so we can feed the stream a full word of data each cycle.
+        stream         = self._stream_type()
+        data_width     = len(stream.data)
+        bytes_per_word = (data_width + 7) // 8
 
         #
-        # Create our constant-stream generators for each of our descriptors.
+        # Descriptor ROM.
         #
+
+        # Rather than creating a separate stream generator (and thus a separate memory) per
+        # descriptor, we'll concatenate all of our descriptors into a single, shared ROM; with
+        # each descriptor aligned to the stream's word size, and a table of each descriptor's
+        # position and extent within the ROM.
+        descriptor_entries = {}
+        descriptor_blob    = bytearray()
+
         for type_number, index, raw_descriptor in self._descriptors:
+            descriptor_entries[(type_number, index)] = (len(descriptor_blob) // bytes_per_word, len(raw_descriptor))
+            descriptor_blob.extend(raw_descriptor)
+
+            # Pad our blob out to our word alignment, so the next descriptor starts on a word boundary.
+            descriptor_blob.extend(b"\0" * (-len(descriptor_blob) % bytes_per_word))
 
-            # Create the generator...
-            generator = ConstantStreamGenerator(raw_descriptor,
-                domain=self._domain, stream_type=self._stream_type, max_length_width=16)
-            descriptor_generators[(type_number, index)] = generator
+        rom_words = [
+            int.from_bytes(descriptor_blob[i:i + bytes_per_word], byteorder="little")
+            for i in range(0, len(descriptor_blob), bytes_per_word)
+        ]
 
-            # ... and attach it to this module.
-            m.submodules += generator
+        rom = Memory(width=data_width, depth=len(rom_words), init=rom_words)
+        m.submodules.rom_read_port = rom_read_port = rom.read_port(transparent=False)
 
 
         #
-        # Connect up each of our generators.
+        # Descriptor selection.
         #
 
-        with m.Switch(self.value):
+        # Word address and extent of the currently-selected descriptor.
+        descriptor_base   = Signal(range(len(rom_words)))
+        descriptor_length = Signal(16)
+        descriptor_found  = Signal()
 
-            # Generate a conditional interconnect for each of our items.
-            for (type_number, index), generator in descriptor_generators.items():
+        # Pre-compute each descriptor's key as a plain integer, so building the cases below
+        # doesn't re-derive it -- or touch descriptor-number enum attributes -- per descriptor.
+        descriptor_cases = [
+            ((int(type_number) << 8) | int(index), entry)
+            for (type_number, index), entry in descriptor_entries.items()
+        ]
 
-                # If the value matches the given type number...
-                with m.Case(type_number << 8 | index):
+        with m.Switch(self.value):
 
-                    # ... connect the relevant generator to our output.
+            # Generate a case for each of our descriptors, which selects the position
+            # and extent of the descriptor's data in our shared ROM.
+            for key, (base_word, raw_length) in descriptor_cases:
+                with m.Case(key):
                     m.d.comb += [
-                        generator.start       .eq(self.start),
-                        generator.max_length  .eq(self.length),
+                        descriptor_base    .eq(base_word),
+                        descriptor_length  .eq(raw_length),
+                        descriptor_found   .eq(1)
                     ]
 
-                    # Buffer the output stream to improve timings.
-                    with m.If(~self.tx.valid.any() | self.tx.ready):
+        # If none of our descriptors match, stall any request that comes in. Deriving this
+        # from our single `found` flag is cheaper -- and more predictable -- than leaving it
+        # to the lowering of a Switch default arm.
+        m.d.comb += self.stall.eq(self.start & ~descriptor_found)
+
+
+        #
+        # Core transmit logic.
+        #
+
+        # Maximum length we're willing to send, latched as each request starts.
+        max_length = Signal(16)
+
+        # Our current word position within the ROM; and the count of bytes sent so far.
+        word_in_rom = Signal(range(len(rom_words)))
+        bytes_sent  = Signal(16)
+
+        # Figure out how many bytes remain before either of our end conditions; the lesser
+        # of the two governs both our `last` flag and our final word's valid lanes.
+        bytes_left_in_data   = descriptor_length - bytes_sent
+        bytes_left_in_packet = max_length - bytes_sent
+        bytes_left           = Signal(16)
+
+        m.d.comb += bytes_left.eq(Mux(
+            bytes_left_in_data < bytes_left_in_packet,
+            bytes_left_in_data,
+            bytes_left_in_packet
+        ))
+
+        on_first_word = bytes_sent == 0
+        on_last_word  = bytes_left <= bytes_per_word
+
+        # Report our max length or the length of our data, whichever is less.
+        output_length = Signal(16)
+        with m.If(max_length < descriptor_length):
+            m.d.comb += output_length.eq(max_length)
+        with m.Else():
+            m.d.comb += output_length.eq(descriptor_length)
+
+        with m.FSM():
+
+            # IDLE -- we're currently waiting to send a descriptor.
+            with m.State('IDLE'):
+
+                # Track the maximum length we'll be allowed to send...
+                m.d.sync += [
+                    max_length   .eq(self.length),
+                    word_in_rom  .eq(descriptor_base),
+                    bytes_sent   .eq(0)
+                ]
+
+                # ... and pre-fetch the first word of the selected descriptor.
+                m.d.comb += rom_read_port.addr.eq(descriptor_base)
+
+                # Once we have a request for a descriptor we know, start streaming.
+                with m.If(self.start & descriptor_found & (self.length > 0)):
+                    m.next = 'STREAMING'
+
+            # STREAMING -- we're actively streaming descriptor words.
+            with m.State('STREAMING'):
+                full_word_valid = 2 ** len(stream.valid) - 1
+
+                m.d.comb += [
+                    # Always drive the stream from our current ROM output...
+                    rom_read_port.addr  .eq(word_in_rom),
+                    stream.payload      .eq(rom_read_port.data),
+
+                    # ... and base First and Last based on our current position in the stream.
+                    stream.first        .eq(on_first_word),
+                    stream.last         .eq(on_last_word)
+                ]
+
+                # Drive a full set of valid lanes for each complete word; our final word
+                # instead carries one valid lane per byte remaining.
+                with m.If(on_last_word):
+                    with m.Switch(bytes_left):
+                        for count in range(1, bytes_per_word):
+                            with m.Case(count):
+                                m.d.comb += stream.valid.eq(2 ** count - 1)
+                        with m.Default():
+                            m.d.comb += stream.valid.eq(full_word_valid)
+                with m.Else():
+                    m.d.comb += stream.valid.eq(full_word_valid)
+
+                # Each time our consumer accepts a word, move on to the next one.
+                with m.If(stream.ready):
+                    with m.If(~on_last_word):
                         m.d.sync += [
-                            self.tx               .stream_eq(generator.stream, omit={'ready'}),
-                            self.tx_length        .eq(generator.output_length)
-                        ]
-                        m.d.comb += [
-                            generator.stream.ready.eq(1),
+                            word_in_rom  .eq(word_in_rom + 1),
+                            bytes_sent   .eq(bytes_sent + bytes_per_word)
                         ]
+                        m.d.comb += rom_read_port.addr.eq(word_in_rom + 1)
+
+                    # Otherwise, we've finished! Return to IDLE.
+                    with m.Else():
+                        m.next = 'IDLE'
+
 
-            # If none of our descriptors match, stall any request that comes in.
-            with m.Case():
-                m.d.comb += self.stall.eq(self.start)
+        # Buffer the output stream to improve timings.
+        with m.If(~self.tx.valid.any() | self.tx.ready):
+            m.d.sync += [
+                self.tx         .stream_eq(stream, omit={'ready'}),
+                self.tx_length  .eq(output_length)
+            ]
+            m.d.comb += [
+                stream.ready    .eq(1),
+            ]
 
         # Convert our sync domain to the domain requested by the user, if necessary.
         if self._domain != "sync":
             m = DomainRenamer({"sync": self._domain})(m)
 
         return m
+
+
+class GetDescriptorHandlerTest(LunaSSGatewareTestCase):
+    descriptors = DeviceDescriptorCollection()
+
+    with descriptors.DeviceDescriptor() as d:
+        d.bcdUSB             = 3.2
+        d.idVendor           = 0x1234
+        d.idProduct          = 0x4567
+        d.iManufacturer      = "Manufacturer"
+        d.iProduct           = "Product"
+        d.iSerialNumber      = "SerialNumber"
+        d.bNumConfigurations = 1
+
+        with descriptors.ConfigurationDescriptor() as c:
+            c.bmAttributes = 0xC0
+            c.bMaxPower = 50
+
+            with c.InterfaceDescriptor() as i:
+                i.bInterfaceNumber   = 0
+                i.bInterfaceClass    = 0x02
+                i.bInterfaceSubclass = 0x02
+                i.bInterfaceProtocol = 0x01
+
+                with i.EndpointDescriptor() as e:
+                    e.bEndpointAddress = 0x81
+                    e.bmAttributes     = 0x03
+                    e.wMaxPacketSize   = 512
+                    e.bInterval        = 11
+
+    FRAGMENT_UNDER_TEST = GetDescriptorHandler
+    FRAGMENT_ARGUMENTS = {"descriptor_collection": descriptors}
+
+    def _collect_descriptor(self, type_number, index, max_length, timeout=100):
+        """ Requests the given descriptor, and collects the bytes our DUT transmits in response. """
+
+        dut = self.dut
+        collected = bytearray()
+
+        # Issue our request...
+        yield dut.value.eq((type_number << 8) | index)
+        yield dut.length.eq(max_length)
+        yield dut.tx.ready.eq(1)
+        yield from self.pulse(dut.start, step_after=False)
+
+        # ... and collect the bytes for each valid lane presented, until our stream ends.
+        cycles_passed = 0
+        while True:
+            valid = yield dut.tx.valid
+
+            if valid:
+                payload = yield dut.tx.payload
+                for lane in range(len(dut.tx.valid)):
+                    if valid & (1 << lane):
+                        collected.append((payload >> (8 * lane)) & 0xFF)
+
+                if (yield dut.tx.last):
+                    yield
+                    break
+
+            cycles_passed += 1
+            if cycles_passed > timeout:
+                raise RuntimeError("Timeout waiting for descriptor!")
+            yield
+
+        return collected
+
+    @ss_domain_test_case
+    def test_all_descriptors(self):
+        for type_number, index, raw_descriptor in self.descriptors:
+            collected = yield from self._collect_descriptor(type_number, index, len(raw_descriptor))
+            self.assertEqual(collected, raw_descriptor)
+            self.assertEqual((yield self.dut.tx_length), len(raw_descriptor))
+
+    @ss_domain_test_case
+    def test_descriptor_with_max_length(self):
+        collected = yield from self._collect_descriptor(StandardDescriptorNumbers.DEVICE, 0, 7)
+        self.assertEqual(collected, self.descriptors.get_descriptor_bytes(StandardDescriptorNumbers.DEVICE)[:7])
+        self.assertEqual((yield self.dut.tx_length), 7)
+
+    @ss_domain_test_case
+    def test_unavailable_descriptor(self):
+        # Request a descriptor we don't have; we should see a stall while our request is active.
+        yield self.dut.value.eq(0x1000)
+        yield self.dut.length.eq(64)
+        yield self.dut.start.eq(1)
+        yield
+        self.assertEqual((yield self.dut.stall), 1)
+        self.assertEqual((yield self.dut.tx.valid), 0)
+
+        yield self.dut.start.eq(0)
+        yield
+        self.assertEqual((yield self.dut.stall), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()